@@ -0,0 +1,482 @@
+"""Offline benchmark for the lambdas in lambda/.
+
+Every lambda_handler runs against in-process fakes of S3, CodeCommit, SNS,
+CodeBuild and CodePipeline loaded with synthetic data, so nothing touches AWS.
+For each scenario it reports wall time, AWS calls per operation, bytes read
+and written to S3 and peak memory.
+
+Usage:
+    python benchmark/lambda_benchmark.py
+    python benchmark/lambda_benchmark.py --repos 50 --prs 200 --history-days 365 --json
+"""
+import argparse
+import contextlib
+import copy
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT_DIR, 'lambda')
+VITALS_SEED_FILE = os.path.join(ROOT_DIR, 's3', 'repository-vitals.json')
+DIGEST_WINDOW_MINUTES = 15
+
+
+class CallRecorder:
+    """Counts AWS calls per operation and S3 bytes moved."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.s3_bytes_read = 0
+        self.s3_bytes_written = 0
+
+    def record(self, operation):
+        self.calls[operation] += 1
+
+
+def etag_of(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class FakeS3:
+    """In-memory bucket, including the IfMatch / IfNoneMatch conditions on writes and deletes."""
+
+    def __init__(self, recorder, objects=None):
+        self.recorder = recorder
+        self.objects = dict(objects or {})
+
+    def check_condition(self, Key, operation, IfMatch=None, IfNoneMatch=None):
+        if IfMatch is not None:
+            if Key not in self.objects:
+                raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, operation)
+            if etag_of(self.objects[Key]) != IfMatch:
+                raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': Key}}, operation)
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': Key}}, operation)
+
+    def get_object(self, Bucket, Key):
+        self.recorder.record('s3.GetObject')
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        body = self.objects[Key]
+        self.recorder.s3_bytes_read += len(body)
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ETag': etag_of(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.recorder.record('s3.PutObject')
+        self.check_condition(Key, 'PutObject', IfMatch, IfNoneMatch)
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        self.recorder.s3_bytes_written += len(body)
+        self.objects[Key] = body
+        return {'ETag': etag_of(body)}
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        self.recorder.record('s3.DeleteObject')
+        self.check_condition(Key, 'DeleteObject', IfMatch)
+        self.objects.pop(Key, None)
+        return {}
+
+    def get_paginator(self, operation_name):
+        return FakeListObjectsPaginator(self)
+
+
+class FakeListObjectsPaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=''):
+        self.s3.recorder.record('s3.ListObjectsV2')
+        keys = sorted(key for key in self.s3.objects if key.startswith(Prefix))
+        yield {'Contents': [{'Key': key, 'Size': len(self.s3.objects[key])} for key in keys]}
+
+
+class FakeCodeCommit:
+    page_size = 100
+
+    def __init__(self, recorder, pull_requests, tags):
+        self.recorder = recorder
+        self.pull_requests = pull_requests
+        self.tags = tags
+
+    def list_pull_requests(self, repositoryName, pullRequestStatus, nextToken=None):
+        self.recorder.record('codecommit.ListPullRequests')
+        ids = [pr_id for pr_id, pr in self.pull_requests.items()
+               if pr['repositoryName'] == repositoryName and pr['pullRequestStatus'] == pullRequestStatus]
+        start = int(nextToken or 0)
+        response = {'pullRequestIds': ids[start:start + self.page_size]}
+        if start + self.page_size < len(ids):
+            response['nextToken'] = str(start + self.page_size)
+        return response
+
+    def get_pull_request(self, pullRequestId):
+        self.recorder.record('codecommit.GetPullRequest')
+        return {'pullRequest': self.pull_requests[pullRequestId]}
+
+    def list_tags_for_resource(self, resourceArn):
+        self.recorder.record('codecommit.ListTagsForResource')
+        return {'tags': self.tags.get(resourceArn.split(':')[-1], {})}
+
+    def post_comment_for_pull_request(self, **kwargs):
+        self.recorder.record('codecommit.PostCommentForPullRequest')
+        return {}
+
+
+class FakeSNS:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.topics = {}
+
+    def list_topics(self):
+        self.recorder.record('sns.ListTopics')
+        return {'Topics': [{'TopicArn': arn} for arn in self.topics]}
+
+    def create_topic(self, Name):
+        self.recorder.record('sns.CreateTopic')
+        arn = f'arn:aws:sns:ap-southeast-1:000000000000:{Name}'
+        self.topics.setdefault(arn, {})
+        return {'TopicArn': arn}
+
+    def list_subscriptions_by_topic(self, TopicArn, NextToken=None):
+        self.recorder.record('sns.ListSubscriptionsByTopic')
+        return {'Subscriptions': [
+            {'SubscriptionArn': sub_arn, 'Protocol': 'email', 'Endpoint': email}
+            for sub_arn, email in self.topics[TopicArn].items()
+        ]}
+
+    def subscribe(self, TopicArn, Protocol, Endpoint, ReturnSubscriptionArn=False):
+        self.recorder.record('sns.Subscribe')
+        sub_arn = f'{TopicArn}:{Endpoint}'
+        self.topics[TopicArn][sub_arn] = Endpoint
+        return {'SubscriptionArn': sub_arn}
+
+    def unsubscribe(self, SubscriptionArn):
+        self.recorder.record('sns.Unsubscribe')
+        for subscriptions in self.topics.values():
+            subscriptions.pop(SubscriptionArn, None)
+        return {}
+
+    def publish(self, **kwargs):
+        self.recorder.record('sns.Publish')
+        return {'MessageId': str(self.recorder.calls['sns.Publish'])}
+
+
+class FakeCodeBuild:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def start_build(self, projectName, **kwargs):
+        self.recorder.record('codebuild.StartBuild')
+        return {'build': {'id': f"{projectName}:{self.recorder.calls['codebuild.StartBuild']}"}}
+
+
+class FakeCodePipeline:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def put_job_success_result(self, jobId):
+        self.recorder.record('codepipeline.PutJobSuccessResult')
+        return {}
+
+    def put_job_failure_result(self, jobId, failureDetails):
+        self.recorder.record('codepipeline.PutJobFailureResult')
+        return {}
+
+
+def load_lambda(file_name):
+    """Import a lambda file by path; the hyphenated names are not importable as modules."""
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-1')
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    module_name = file_name.replace('-', '_').replace('.py', '')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LAMBDA_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_fake(module, attribute, service_name, fake):
+    """Replace a lambda's module-level client, keeping the instrumentation proxy in front of the fake."""
+    setattr(module, attribute, module.instrument_client(fake, service_name))
+
+
+def repository_names(count):
+    return [f'cdx-bench-repo-{i:04d}' for i in range(count)]
+
+
+def build_pull_requests(repos, prs_per_repo, end_date, history_days, rng):
+    pull_requests = {}
+    for repo in repos:
+        for i in range(prs_per_repo):
+            pr_id = f'{repo}-{i}'
+            created = datetime.combine(end_date, datetime.min.time(), timezone.utc) - timedelta(
+                days=rng.randrange(history_days + 1), hours=rng.randrange(24))
+            status = rng.choice(['OPEN', 'CLOSED'])
+            pull_requests[pr_id] = {
+                'pullRequestId': pr_id,
+                'repositoryName': repo,
+                'pullRequestStatus': status,
+                'creationDate': created,
+                'pullRequestTargets': [{'mergeMetadata': {'isMerged': status == 'CLOSED' and rng.random() < 0.7}}]
+            }
+    return pull_requests
+
+
+def build_vitals_history(repos, end_date, history_days, missing_days, rng):
+    """Synthetic vitals file shaped like s3/repository-vitals.json; the last `missing_days` are left unfilled."""
+    with open(VITALS_SEED_FILE) as f:
+        seed = json.load(f)
+    template = seed[0]['data'][0]
+    history = []
+    for repo in repos:
+        data = []
+        for n in range(history_days, missing_days - 1, -1):
+            entry = copy.deepcopy(template)
+            entry['date'] = (end_date - timedelta(days=n)).strftime('%Y-%m-%d')
+            entry['pr_status'] = {'open': rng.randrange(3), 'closed': rng.randrange(3), 'merged': rng.randrange(5)}
+            entry['pr_count'] = sum(entry['pr_status'].values())
+            data.append(entry)
+        history.append({'repository_name': repo, 'data': data})
+    return history
+
+
+def build_catalogue(size, rng):
+    return [{
+        'repository_name': f'cdx-catalogue-repo-{i:05d}',
+        'api_inventory_url': f'https://api.cicd.cdx-bankislam.com/cdx-catalogue-repo-{i:05d}/index.html',
+        'trigger_date': '2024-01-01T00:00:00.000Z',
+        'status': True,
+        'repository_owner': rng.choice(['core', 'payments', 'lending']),
+        'repository_domain': rng.choice(['retail', 'corporate']),
+        'repository_subdomain': rng.choice(['cards', 'accounts', 'loans'])
+    } for i in range(size)]
+
+
+def build_repo_tags(repos):
+    return {repo: {'Project': 'bench', 'Domain': f'domain-{i % 4}', 'Sub-Domain': f'sub-{i % 8}'}
+            for i, repo in enumerate(repos)}
+
+
+def build_mailing_list(digest):
+    tags = []
+    for i in range(4):
+        tag = {'key': 'Domain', 'value': f'domain-{i}', 'emails': [f'team-{i}-{n}@example.com' for n in range(3)]}
+        if digest:
+            tag['digest'] = {'enabled': True, 'window_minutes': DIGEST_WINDOW_MINUTES}
+        tags.append(tag)
+    return {'tags': tags}
+
+
+def sonarqube_webhook(repo, rng, index):
+    pr_triggered = rng.random() < 0.5
+    properties = {'sonar.analysis.pr_triggered': 'true' if pr_triggered else 'false'}
+    if pr_triggered:
+        properties.update({
+            'sonar.analysis.pull_request_id': str(index),
+            'sonar.analysis.source_commit': 'a' * 40,
+            'sonar.analysis.destination_commit': 'b' * 40,
+            'sonar.analysis.pr_branch': f'feature/{index}',
+            'sonar.analysis.pr_base': 'main'
+        })
+    return {'body': json.dumps({
+        'qualityGate': {'status': rng.choice(['OK', 'OK', 'OK', 'ERROR']),
+                        'conditions': [{'metric': 'new_coverage', 'status': 'OK', 'value': '81.5'}]},
+        'project': {'name': repo, 'key': repo},
+        'branch': {'name': rng.choice(['main', 'develop'])},
+        'properties': properties
+    })}
+
+
+def scenario_api_inventory(args, rng):
+    module = load_lambda('cdx-api-inventory.py')
+    recorder = CallRecorder()
+    repos = repository_names(args.repos)
+    install_fake(module, 's3', 's3', FakeS3(recorder, {module.file_key: json.dumps(build_catalogue(args.catalogue, rng), indent=4).encode('utf-8')}))
+    install_fake(module, 'codecommit', 'codecommit', FakeCodeCommit(recorder, {}, build_repo_tags(repos)))
+    install_fake(module, 'codebuild', 'codebuild', FakeCodeBuild(recorder))
+    install_fake(module, 'codepipeline', 'codepipeline', FakeCodePipeline(recorder))
+    events = [{'repository-name': rng.choice(repos)} for _ in range(args.burst)]
+    return module, recorder, events
+
+
+def vitals_scenario(file_name, repo_param, args, rng):
+    module = load_lambda(file_name)
+    recorder = CallRecorder()
+    repos = repository_names(args.repos)
+    end_date = datetime.now().date()
+    history = build_vitals_history(repos, end_date, args.history_days, args.missing_days, rng)
+    install_fake(module, 's3_client', 's3', FakeS3(recorder, {module.file_key: json.dumps(history).encode('utf-8')}))
+    install_fake(module, 'codecommit_client', 'codecommit', FakeCodeCommit(
+        recorder, build_pull_requests(repos, args.prs, end_date, args.history_days, rng), build_repo_tags(repos)))
+    start_date = end_date - timedelta(days=args.query_days - 1)
+    events = [{'queryStringParameters': {
+        repo_param: repo,
+        'start-date': start_date.strftime('%Y-%m-%d'),
+        'end-date': end_date.strftime('%Y-%m-%d')
+    }} for repo in rng.sample(repos, min(args.burst, len(repos)))]
+    return module, recorder, events
+
+
+def scenario_repository_vitals(args, rng):
+    return vitals_scenario('cdx-repository-vitals.py', 'repository-name', args, rng)
+
+
+def scenario_repository_vitals_organisation(args, rng):
+    """Organisation-wide queries served from the aggregates, built up front from the synthetic history."""
+    module, recorder, events = vitals_scenario('cdx-repository-vitals.py', 'repository-name', args, rng)
+    history = json.loads(module.s3_client.objects[module.file_key])
+    module.update_aggregates(history, history[0]['repository_name'], [])
+    recorder.calls.clear()
+    recorder.s3_bytes_read = recorder.s3_bytes_written = 0
+    for event in events:
+        del event['queryStringParameters']['repository-name']
+        event['queryStringParameters']['scope'] = 'organisation'
+    return module, recorder, events
+
+
+def scenario_experiment_delete_soon(args, rng):
+    return vitals_scenario('cdx-experiment-delete-soon.py', 'repository_name', args, rng)
+
+
+def backdate_digest_windows(s3, minutes):
+    """Move the window start of every buffered digest back, as if the window had elapsed."""
+    for key, body in list(s3.objects.items()):
+        if key.startswith('digest/'):
+            buffer = json.loads(body)
+            buffer['window_start'] = (datetime.fromisoformat(buffer['window_start']) - timedelta(minutes=minutes)).isoformat()
+            s3.objects[key] = json.dumps(buffer).encode('utf-8')
+
+
+def notification_scenario(args, rng, digest):
+    module = load_lambda('cdx-sonarqube-result-email-notif.py')
+    recorder = CallRecorder()
+    repos = repository_names(args.repos)
+    s3 = FakeS3(recorder, {'config/mailing_list.json': json.dumps(build_mailing_list(digest)).encode('utf-8')})
+    install_fake(module, 's3_obj', 's3', s3)
+    install_fake(module, 'codecommit', 'codecommit', FakeCodeCommit(recorder, {}, build_repo_tags(repos)))
+    install_fake(module, 'sns_send', 'sns', FakeSNS(recorder))
+    install_fake(module, 'codebuild', 'codebuild', FakeCodeBuild(recorder))
+    events = [sonarqube_webhook(rng.choice(repos), rng, i) for i in range(args.burst)]
+    if digest:
+        # Let the windows elapse, then run the scheduled flush that sends the buffered digests
+        events.append(lambda: backdate_digest_windows(s3, DIGEST_WINDOW_MINUTES))
+        events.append({'detail-type': 'Scheduled Event', 'source': 'aws.events', 'detail': {}})
+    return module, recorder, events
+
+
+def scenario_sonarqube_notif(args, rng):
+    return notification_scenario(args, rng, digest=False)
+
+
+def scenario_sonarqube_notif_digest(args, rng):
+    return notification_scenario(args, rng, digest=True)
+
+
+SCENARIOS = {
+    'api-inventory': scenario_api_inventory,
+    'repository-vitals': scenario_repository_vitals,
+    'repository-vitals-organisation': scenario_repository_vitals_organisation,
+    'experiment-delete-soon': scenario_experiment_delete_soon,
+    'sonarqube-notif': scenario_sonarqube_notif,
+    'sonarqube-notif-digest': scenario_sonarqube_notif_digest,
+}
+
+
+def run_events(module, events):
+    # Handlers print to stdout; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for event in events:
+            run_event(module, event)
+
+
+def run_event(module, event):
+    # Scenarios may interleave setup steps, such as moving the clock of stored state, with the events
+    if callable(event):
+        event()
+        return
+    response = module.lambda_handler(event, None)
+    if response.get('statusCode') != 200:
+        raise RuntimeError(f"{module.__name__} returned {response.get('statusCode')}: {response.get('body')}")
+
+
+def run_scenario(name, args):
+    """Run a scenario `repeat` times on fresh state for timing, then once more under tracemalloc."""
+    timings = []
+    recorder = None
+    for i in range(args.repeat):
+        module, recorder, events = SCENARIOS[name](args, random.Random(args.seed))
+        start = time.perf_counter()
+        run_events(module, events)
+        timings.append(time.perf_counter() - start)
+
+    module, _, events = SCENARIOS[name](args, random.Random(args.seed))
+    tracemalloc.start()
+    run_events(module, events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'invocations': sum(1 for event in events if not callable(event)),
+        'wall_ms_median': round(statistics.median(timings) * 1000, 2),
+        'wall_ms_min': round(min(timings) * 1000, 2),
+        'aws_calls': sum(recorder.calls.values()),
+        'aws_calls_by_operation': dict(sorted(recorder.calls.items())),
+        's3_bytes_read': recorder.s3_bytes_read,
+        's3_bytes_written': recorder.s3_bytes_written,
+        'peak_memory_bytes': peak
+    }
+
+
+def print_report(results):
+    header = f"{'scenario':<32}{'calls':>8}{'median ms':>12}{'min ms':>10}{'S3 read':>12}{'S3 written':>12}{'peak mem':>12}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['scenario']:<32}{result['aws_calls']:>8}{result['wall_ms_median']:>12}"
+              f"{result['wall_ms_min']:>10}{result['s3_bytes_read']:>12}{result['s3_bytes_written']:>12}"
+              f"{result['peak_memory_bytes']:>12}")
+    for result in results:
+        print(f"\n{result['scenario']} ({result['invocations']} invocations)")
+        for operation, count in result['aws_calls_by_operation'].items():
+            print(f"  {operation:<40}{count:>8}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument('--repos', type=int, default=20, help='number of repositories')
+    parser.add_argument('--prs', type=int, default=50, help='pull requests per repository')
+    parser.add_argument('--history-days', type=int, default=180, help='days of vitals history per repository')
+    parser.add_argument('--missing-days', type=int, default=3, help='most recent days left out of the vitals history')
+    parser.add_argument('--query-days', type=int, default=30, help='days covered by each vitals query')
+    parser.add_argument('--catalogue', type=int, default=500, help='entries in the API catalogue')
+    parser.add_argument('--burst', type=int, default=20, help='invocations per scenario (webhook burst size)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for the synthetic data')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = [run_scenario(name, args) for name in (args.scenario or SCENARIOS)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
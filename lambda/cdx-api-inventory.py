@@ -2,12 +2,13 @@ import json
 import boto3
 from datetime import datetime
 from botocore.exceptions import ClientError
+from cdx_instrumentation import instrument_client, instrumented_handler, log_payload, phase
 
 # Initialize AWS clients
-s3 = boto3.client('s3')
-codebuild = boto3.client('codebuild')
-codepipeline = boto3.client('codepipeline')
-codecommit = boto3.client('codecommit', region_name='ap-southeast-1')
+s3 = instrument_client(boto3.client('s3'), 's3')
+codebuild = instrument_client(boto3.client('codebuild'), 'codebuild')
+codepipeline = instrument_client(boto3.client('codepipeline'), 'codepipeline')
+codecommit = instrument_client(boto3.client('codecommit', region_name='ap-southeast-1'), 'codecommit')
 
 bucket_name = 'beu-api-inventory-web'
 file_key = 'catalogue-counter.txt'  # The file path in S3
@@ -47,10 +48,12 @@ def get_existing_catalogue(bucket_name, file_key):
 def update_catalogue_for_repository(repository_name, bucket_name, file_key):
     """Update a specific repository entry in the catalogue-counter.txt in S3."""
     # Fetch the existing catalogue from S3
-    existing_catalogue = get_existing_catalogue(bucket_name, file_key)
+    with phase('load_store'):
+        existing_catalogue = get_existing_catalogue(bucket_name, file_key)
 
     # Get CodeCommit tags for the repository
-    repository_tags = get_codecommit_tags(repository_name)
+    with phase('fetch'):
+        repository_tags = get_codecommit_tags(repository_name)
     
     # Set the trigger date to now
     trigger_date = datetime.now().strftime('%Y-%m-%dT%H:%M:%S.000Z')
@@ -89,15 +92,17 @@ def update_catalogue_for_repository(repository_name, bucket_name, file_key):
         })
 
     # Upload the updated catalogue back to S3
-    s3.put_object(
-        Bucket=bucket_name, 
-        Key=file_key, 
-        Body=json.dumps(updated_catalogue, indent=4),
-        ContentType='application/json'
-    )
+    with phase('write'):
+        s3.put_object(
+            Bucket=bucket_name, 
+            Key=file_key, 
+            Body=json.dumps(updated_catalogue, indent=4),
+            ContentType='application/json'
+        )
     
     return updated_catalogue
 
+@instrumented_handler('cdx-api-inventory')
 def lambda_handler(event, context):
     try:
         # Determine if the trigger is from CodePipeline or Direct Invocation
@@ -118,7 +123,7 @@ def lambda_handler(event, context):
 
         # Update the repository in the catalogue
         updated_catalogue = update_catalogue_for_repository(repository_name, bucket_name, file_key)
-        print(f"Updated catalogue: {updated_catalogue}")
+        log_payload("Updated catalogue", updated_catalogue)
 
         # Start the CodeBuild project (assuming this is required)
         response = codebuild.start_build(
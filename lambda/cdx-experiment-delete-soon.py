@@ -2,9 +2,10 @@ import json
 import boto3
 from datetime import datetime, timedelta, timezone
 from botocore.exceptions import ClientError
+from cdx_instrumentation import instrument_client, instrumented_handler, log_payload, phase
 
-s3_client = boto3.client('s3')
-codecommit_client = boto3.client('codecommit')
+s3_client = instrument_client(boto3.client('s3'), 's3')
+codecommit_client = instrument_client(boto3.client('codecommit'), 'codecommit')
 bucket_name = 'cdx-git-tag-poc-bucket'
 file_key = 'json/repository_vitals.json'
 
@@ -60,7 +61,9 @@ def get_pr_data_from_codecommit(repository_name, date):
 
     return {"date": date.strftime('%Y-%m-%d'), "pr_count": date_count["pr_count"]}
 
+@instrumented_handler('cdx-experiment-delete-soon')
 def lambda_handler(event, context):
+    log_payload("Received event", event)
     query_params = event.get('queryStringParameters', {})
     repository_name = query_params.get('repository_name', 'cdx-sq-pull-request')
     start_date_str = query_params.get('start-date', '2024-08-01')
@@ -72,9 +75,10 @@ def lambda_handler(event, context):
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
 
         # Retrieve the file from S3
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        data = json.loads(file_content)
+        with phase('load_store'):
+            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+            file_content = response['Body'].read().decode('utf-8')
+            data = json.loads(file_content)
         
         # Find or create entry for the repository
         repo_data_entry = next((repo for repo in data if repo['repository_name'] == repository_name), None)
@@ -92,21 +96,22 @@ def lambda_handler(event, context):
         total_closed = 0
         total_merged = 0
 
-        for n in range((end_date - start_date).days + 1):
-            current_date = (start_date + timedelta(days=n)).strftime('%Y-%m-%d')
-            if current_date in existing_dates:
-                # Append only date and pr_count from existing data
-                entry = existing_dates[current_date]
-                pr_data.append({
-                    "date": current_date,
-                    "pr_count": entry["pr_count"]
-                })
-                # Accumulate pr_status within date range
-                total_open += entry["pr_status"]["open"]
-                total_closed += entry["pr_status"]["closed"]
-                total_merged += entry["pr_status"]["merged"]
-            else:
-                missing_dates.append(current_date)
+        with phase('aggregate'):
+            for n in range((end_date - start_date).days + 1):
+                current_date = (start_date + timedelta(days=n)).strftime('%Y-%m-%d')
+                if current_date in existing_dates:
+                    # Append only date and pr_count from existing data
+                    entry = existing_dates[current_date]
+                    pr_data.append({
+                        "date": current_date,
+                        "pr_count": entry["pr_count"]
+                    })
+                    # Accumulate pr_status within date range
+                    total_open += entry["pr_status"]["open"]
+                    total_closed += entry["pr_status"]["closed"]
+                    total_merged += entry["pr_status"]["merged"]
+                else:
+                    missing_dates.append(current_date)
 
         # Calculate overall counts for the response
         result = {
@@ -139,18 +144,20 @@ def lambda_handler(event, context):
         }
 
         # Fetch and update missing dates inline
-        for date_str in missing_dates:
-            date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-            new_data = get_pr_data_from_codecommit(repository_name, date_obj)
-            repo_data_entry['data'].append(new_data)
+        with phase('fetch'):
+            for date_str in missing_dates:
+                date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
+                new_data = get_pr_data_from_codecommit(repository_name, date_obj)
+                repo_data_entry['data'].append(new_data)
 
         # Sort data by date to maintain order and update S3
-        repo_data_entry['data'].sort(key=lambda x: x['date'])
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=file_key,
-            Body=json.dumps(data)  # Ensure JSON data is stringified
-        )
+        with phase('write'):
+            repo_data_entry['data'].sort(key=lambda x: x['date'])
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=file_key,
+                Body=json.dumps(data)  # Ensure JSON data is stringified
+            )
 
         return response_data
 
@@ -1,12 +1,25 @@
 import json
+import os
 import boto3
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
+from cdx_instrumentation import instrument_client, instrumented_handler, log_payload, phase
+from cdx_s3_store import read_json, update_json
 
-s3_client = boto3.client('s3')
-codecommit_client = boto3.client('codecommit')
+s3_client = instrument_client(boto3.client('s3'), 's3')
+codecommit_client = instrument_client(boto3.client('codecommit'), 'codecommit')
 bucket_name = 'cdk-data-pipeline-center-test'
 file_key = 'api-inventory-automation-script/repository-vitals.json'
+aggregates_prefix = 'api-inventory-automation-script/repository-vitals-aggregates/'
+aggregates_index_key = f'{aggregates_prefix}repositories.json'
+region = os.getenv('AWS_REGION', 'ap-southeast-1')
+
+# Query scope -> (aggregates section, query parameter naming the tag value)
+aggregate_scopes = {
+    'organisation': ('organisation', None),
+    'domain': ('domain', 'domain'),
+    'sub-domain': ('sub_domain', 'sub-domain'),
+}
 
 def fetch_all_pull_requests(client, repository_name, status):
     pull_request_ids = []
@@ -52,7 +65,221 @@ def get_pr_data_from_codecommit(repository_name, date):
 
     return {"date": date.strftime('%Y-%m-%d'), "pr_count": date_count["pr_count"], "pr_status": date_count["pr_status"]}
 
+def get_repository_tags(repository_name):
+    """Retrieve the Domain and Sub-Domain tags of a CodeCommit repository.
+
+    A repository that no longer exists has no tags. Other errors are raised rather than treated
+    as "no tags", which would move the repository's history out of its Domain/Sub-Domain aggregates.
+    """
+    try:
+        with phase('fetch'):
+            response = codecommit_client.list_tags_for_resource(
+                resourceArn=f'arn:aws:codecommit:{region}:482680362026:{repository_name}'
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'RepositoryDoesNotExistException':
+            print(f"Repository {repository_name} no longer exists, aggregating it without Domain/Sub-Domain")
+            return {'domain': None, 'sub_domain': None}
+        raise e
+    tags = response.get('tags', {})
+    return {'domain': tags.get('Domain'), 'sub_domain': tags.get('Sub-Domain')}
+
+def aggregate_key(section, month):
+    return f'{aggregates_prefix}{section}/{month}.json'
+
+def section_value(section, tags):
+    """The bucket a repository's entries go to in a section: one bucket for the organisation, its tag value otherwise."""
+    return 'all' if section == 'organisation' else tags[section]
+
+def date_ranges(dates):
+    """Compress sorted 'YYYY-MM-DD' strings into [first, last] ranges of consecutive days."""
+    ranges = []
+    for date_str in dates:
+        if ranges and (datetime.strptime(ranges[-1][1], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') == date_str:
+            ranges[-1][1] = date_str
+        else:
+            ranges.append([date_str, date_str])
+    return ranges
+
+def expand_date_ranges(ranges):
+    dates = set()
+    for first, last in ranges:
+        current = datetime.strptime(first, '%Y-%m-%d')
+        while current.strftime('%Y-%m-%d') <= last:
+            dates.add(current.strftime('%Y-%m-%d'))
+            current += timedelta(days=1)
+    return dates
+
+def add_to_day_buckets(day_buckets, entry, sign=1):
+    bucket = day_buckets.setdefault(entry['date'], {"pr_count": 0, "pr_status": {"open": 0, "closed": 0, "merged": 0}})
+    bucket["pr_count"] += sign * entry["pr_count"]
+    for status in bucket["pr_status"]:
+        bucket["pr_status"][status] += sign * entry["pr_status"][status]
+
+def merge_repository_month(month_aggregate, repository_name, value, entries):
+    """Add a repository's day entries for one month of one section under `value`. Returns False if nothing changed.
+
+    Each month object records which of the repository's dates it already holds (as date ranges) and
+    under which value, so entries are added exactly once even when an earlier update failed part-way,
+    and a repository whose tag changed has its entries moved to the new value.
+    """
+    buckets = month_aggregate['buckets']
+    stored = month_aggregate['aggregated'].get(repository_name)
+    aggregated_dates = expand_date_ranges(stored['dates']) if stored else set()
+    changed = False
+
+    if stored and stored['value'] != value:
+        for entry in entries:
+            if entry['date'] in aggregated_dates:
+                if stored['value']:
+                    add_to_day_buckets(buckets.setdefault(stored['value'], {}), entry, -1)
+                if value:
+                    add_to_day_buckets(buckets.setdefault(value, {}), entry)
+        changed = True
+
+    new_entries = [entry for entry in entries if entry['date'] not in aggregated_dates]
+    for entry in new_entries:
+        if value:
+            add_to_day_buckets(buckets.setdefault(value, {}), entry)
+    if not new_entries and not changed:
+        return False
+
+    aggregated_dates.update(entry['date'] for entry in new_entries)
+    month_aggregate['aggregated'][repository_name] = {'value': value, 'dates': date_ranges(sorted(aggregated_dates))}
+    return True
+
+def update_aggregates(data, repository_name, new_entries):
+    """Add day entries from the vitals file to the aggregates.
+
+    The aggregates are split into one object per section (organisation, domain, sub_domain) and
+    month, so a query reads only the months in its range. Only the months of new_entries are
+    updated, with every entry of the repository in those months that they do not hold yet; that
+    also adds entries left out by an earlier failed update. When the repository's tags changed,
+    all its months are updated. The first time, or after the aggregates prefix is deleted to force
+    a rebuild, they are built from every repository's history; the index of repository tags is
+    written last and marks the aggregates as built.
+    """
+    with phase('load_store'):
+        index, _ = read_json(s3_client, bucket_name, aggregates_index_key)
+
+    repositories = data if index is None else [repo for repo in data if repo['repository_name'] == repository_name]
+    new_dates = {entry['date'] for entry in new_entries}
+    tags_by_repository = {}
+    updates = {}
+    with phase('aggregate'):
+        for repo in repositories:
+            tags = get_repository_tags(repo['repository_name'])
+            tags_by_repository[repo['repository_name']] = tags
+            rebuild = index is None or index.get(repo['repository_name']) != tags
+            months = {entry['date'][:7] for entry in repo['data'] if rebuild or entry['date'] in new_dates}
+            for month in months:
+                entries = [entry for entry in repo['data'] if entry['date'][:7] == month]
+                for section in ('organisation', 'domain', 'sub_domain'):
+                    updates.setdefault((section, month), []).append((repo['repository_name'], section_value(section, tags), entries))
+
+    def apply(month_updates):
+        def update(month_aggregate):
+            if month_aggregate is None:
+                month_aggregate = {'buckets': {}, 'aggregated': {}}
+            changed = False
+            for name, value, entries in month_updates:
+                changed = merge_repository_month(month_aggregate, name, value, entries) or changed
+            return month_aggregate if changed else None
+        return update
+
+    with phase('write'):
+        for (section, month), month_updates in sorted(updates.items()):
+            update_json(s3_client, bucket_name, aggregate_key(section, month), apply(month_updates))
+
+        def update_index(current):
+            current = current or {}
+            if all(current.get(name) == tags for name, tags in tags_by_repository.items()):
+                return None
+            current.update(tags_by_repository)
+            return current
+        update_json(s3_client, bucket_name, aggregates_index_key, update_index)
+
+def summarise_pr_status(total_open, total_closed, total_merged):
+    total_pr_count = total_open + total_closed + total_merged
+    return {
+        "pr_status": {
+            "open": total_open,
+            "closed": total_closed,
+            "merged": total_merged
+        },
+        "pr_status_percentage": {
+            "open_percentage": round((total_open / total_pr_count) * 100, 2) if total_pr_count else 0.0,
+            "closed_percentage": round((total_closed / total_pr_count) * 100, 2) if total_pr_count else 0.0,
+            "merged_percentage": round((total_merged / total_pr_count) * 100, 2) if total_pr_count else 0.0
+        }
+    }
+
+def summarise_day_buckets(day_buckets, start_date, end_date):
+    pr_data = []
+    total_open = 0
+    total_closed = 0
+    total_merged = 0
+    for n in range((end_date - start_date).days + 1):
+        current_date_str = (start_date + timedelta(days=n)).strftime('%Y-%m-%d')
+        bucket = day_buckets.get(current_date_str)
+        if bucket:
+            pr_data.append({"date": current_date_str, "pr_count": bucket["pr_count"]})
+            total_open += bucket["pr_status"]["open"]
+            total_closed += bucket["pr_status"]["closed"]
+            total_merged += bucket["pr_status"]["merged"]
+    return pr_data, summarise_pr_status(total_open, total_closed, total_merged)
+
+def months_between(start_date, end_date):
+    months = []
+    current = start_date.replace(day=1)
+    while current <= end_date:
+        months.append(current.strftime('%Y-%m'))
+        current = (current + timedelta(days=32)).replace(day=1)
+    return months
+
+def get_aggregate_vitals(query_params, start_date, end_date):
+    """Serve organisation-wide or per Domain/Sub-Domain vitals from the aggregates, without touching CodeCommit.
+
+    scope=organisation gives totals over all repositories. scope=domain or scope=sub-domain gives
+    the totals for the tag value passed in domain/sub-domain, or a breakdown of every value if none is passed.
+    Only the month objects of the requested range are read. Returns None if the aggregates have not been built.
+    """
+    scope = query_params['scope']
+    if scope not in aggregate_scopes:
+        raise ValueError(f"Unknown scope '{scope}', expected organisation, domain or sub-domain")
+    section, param = aggregate_scopes[scope]
+
+    buckets = {}
+    found = False
+    with phase('load_store'):
+        for month in months_between(start_date, end_date):
+            month_aggregate, _ = read_json(s3_client, bucket_name, aggregate_key(section, month))
+            if month_aggregate:
+                found = True
+                for value, day_buckets in month_aggregate['buckets'].items():
+                    buckets.setdefault(value, {}).update(day_buckets)
+        # No month in range: either the range has no data or the aggregates were never built
+        if not found and read_json(s3_client, bucket_name, aggregates_index_key)[0] is None:
+            return None
+
+    with phase('aggregate'):
+        if scope == 'organisation':
+            pr_data, summary = summarise_day_buckets(buckets.get('all', {}), start_date, end_date)
+            return {"scope": scope, "pr_data": pr_data, **summary}
+
+        tag_value = query_params.get(param)
+        if tag_value:
+            pr_data, summary = summarise_day_buckets(buckets.get(tag_value, {}), start_date, end_date)
+            return {"scope": scope, param: tag_value, "pr_data": pr_data, **summary}
+
+        breakdown = {}
+        for value, day_buckets in sorted(buckets.items()):
+            _, breakdown[value] = summarise_day_buckets(day_buckets, start_date, end_date)
+        return {"scope": scope, "breakdown": breakdown}
+
+@instrumented_handler('cdx-repository-vitals')
 def lambda_handler(event, context):
+    log_payload("Received event", event)
     query_params = event.get('queryStringParameters', {})
     repository_name = query_params.get('repository-name', 'cdx-android-app')
     end_date_default = datetime.now().date()
@@ -64,9 +291,33 @@ def lambda_handler(event, context):
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
 
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        data = json.loads(file_content)
+        if 'scope' in query_params:
+            try:
+                result = get_aggregate_vitals(query_params, start_date, end_date)
+            except ValueError as e:
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": str(e)})
+                }
+            if result is None:
+                return {
+                    "statusCode": 503,
+                    "body": json.dumps({"error": "Vitals aggregates not built yet"})
+                }
+            return {
+                "statusCode": 200,
+                "headers": {
+                    "Access-Control-Allow-Origin": "*",
+                    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                    "Access-Control-Allow-Headers": "Content-Type"
+                },
+                "body": json.dumps(result)
+            }
+
+        with phase('load_store'):
+            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+            file_content = response['Body'].read().decode('utf-8')
+            data = json.loads(file_content)
         
         repo_data_entry = next((repo for repo in data if repo['repository_name'] == repository_name), None)
         if repo_data_entry is None:
@@ -81,61 +332,64 @@ def lambda_handler(event, context):
 
         # Ensure all dates from the last entry up to today are populated
         pr_data = []
+        new_entries = []
         total_open = 0
         total_closed = 0
         total_merged = 0
 
-        for n in range((end_date - start_date).days + 1):
-            current_date = start_date + timedelta(days=n)
-            current_date_str = current_date.strftime('%Y-%m-%d')
-
-            # Check if date exists in JSON
-            existing_entry = next((entry for entry in repo_data_entry['data'] if entry['date'] == current_date_str), None)
-            if existing_entry:
-                pr_data.append({
-                    "date": current_date_str,
-                    "pr_count": existing_entry["pr_count"]
-                })
-                total_open += existing_entry["pr_status"]["open"]
-                total_closed += existing_entry["pr_status"]["closed"]
-                total_merged += existing_entry["pr_status"]["merged"]
-            else:
-                # Only fetch data from CodeCommit for dates up to today (not future dates)
-                if current_date <= end_date_default:
-                    new_data = get_pr_data_from_codecommit(repository_name, current_date)
+        with phase('aggregate'):
+            for n in range((end_date - start_date).days + 1):
+                current_date = start_date + timedelta(days=n)
+                current_date_str = current_date.strftime('%Y-%m-%d')
+
+                # Check if date exists in JSON
+                existing_entry = next((entry for entry in repo_data_entry['data'] if entry['date'] == current_date_str), None)
+                if existing_entry:
                     pr_data.append({
                         "date": current_date_str,
-                        "pr_count": new_data["pr_count"]
+                        "pr_count": existing_entry["pr_count"]
                     })
-                    total_open += new_data["pr_status"]["open"]
-                    total_closed += new_data["pr_status"]["closed"]
-                    total_merged += new_data["pr_status"]["merged"]
-                    # Append new data only for non-future dates
-                    repo_data_entry['data'].append(new_data)
+                    total_open += existing_entry["pr_status"]["open"]
+                    total_closed += existing_entry["pr_status"]["closed"]
+                    total_merged += existing_entry["pr_status"]["merged"]
+                else:
+                    # Only fetch data from CodeCommit for dates up to today (not future dates)
+                    if current_date <= end_date_default:
+                        with phase('fetch'):
+                            new_data = get_pr_data_from_codecommit(repository_name, current_date)
+                        pr_data.append({
+                            "date": current_date_str,
+                            "pr_count": new_data["pr_count"]
+                        })
+                        total_open += new_data["pr_status"]["open"]
+                        total_closed += new_data["pr_status"]["closed"]
+                        total_merged += new_data["pr_status"]["merged"]
+                        # Append new data only for non-future dates
+                        repo_data_entry['data'].append(new_data)
+                        new_entries.append(new_data)
 
         # Sort and write back to S3 only if new data was added
-        repo_data_entry['data'].sort(key=lambda x: x['date'])
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=file_key,
-            Body=json.dumps(data)
-        )
+        with phase('write'):
+            repo_data_entry['data'].sort(key=lambda x: x['date'])
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=file_key,
+                Body=json.dumps(data)
+            )
+
+        # Keep the organisation-wide aggregates in step with the day buckets just written. A failure
+        # here does not fail the request; the next update of the same months adds the missing entries
+        if new_entries:
+            try:
+                update_aggregates(data, repository_name, new_entries)
+            except Exception as e:
+                print(f"Failed to update vitals aggregates for {repository_name}: {e}")
 
         # Prepare the response data
-        total_pr_count = total_open + total_closed + total_merged
         result = {
             "repository_name": repository_name,
             "pr_data": pr_data,
-            "pr_status": {
-                "open": total_open,
-                "closed": total_closed,
-                "merged": total_merged
-            },
-            "pr_status_percentage": {
-                "open_percentage": round((total_open / total_pr_count) * 100, 2) if total_pr_count else 0.0,
-                "closed_percentage": round((total_closed / total_pr_count) * 100, 2) if total_pr_count else 0.0,
-                "merged_percentage": round((total_merged / total_pr_count) * 100, 2) if total_pr_count else 0.0
-            }
+            **summarise_pr_status(total_open, total_closed, total_merged)
         }
 
         return {
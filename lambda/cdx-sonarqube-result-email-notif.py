@@ -2,15 +2,20 @@ import json
 import boto3
 import logging
 import os
-from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import BotoCoreError, ClientError
+from cdx_instrumentation import instrument_client, instrumented_handler, log_payload, phase
+from cdx_s3_store import delete_if_unchanged, read_json, update_json
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_obj = boto3.client('s3')
-codecommit = boto3.client('codecommit')
-sns_send = boto3.client('sns')
-codebuild = boto3.client('codebuild')
+s3_obj = instrument_client(boto3.client('s3'), 's3')
+codecommit = instrument_client(boto3.client('codecommit'), 'codecommit')
+sns_send = instrument_client(boto3.client('sns'), 'sns')
+codebuild = instrument_client(boto3.client('codebuild'), 'codebuild')
+
+digest_prefix = "digest/"
 
 def get_or_create_sns_topic(topic_name):
     try:
@@ -48,6 +53,126 @@ def unsubscribe_email_from_topic(subscription_arn):
     except ClientError as e:
         logger.error(f"Failed to unsubscribe {subscription_arn}: {e}")
 
+def digest_key(topic_name):
+    return f"{digest_prefix}{topic_name}.json"
+
+def digest_window_elapsed(buffer, now):
+    window_start = datetime.fromisoformat(buffer['window_start'])
+    return now - window_start >= timedelta(minutes=buffer['window_minutes'])
+
+def describe_digest_target(entry):
+    if entry['pr_triggered'] == 'true':
+        return f"Pull Request {entry['pull_request_id']} ({entry['pr_branch']} -> {entry['pr_base']})"
+    return f"Branch {entry['branch_name']}"
+
+def format_digest_message(entries):
+    """Build one message for the buffered results, grouped by repository and quality gate status.
+
+    Results that were already sent on their own are only listed in a closing summary line.
+    """
+    pending = [entry for entry in entries.values() if not entry.get('notified')]
+    notified = [entry for entry in entries.values() if entry.get('notified')]
+    grouped = {}
+    for entry in pending:
+        grouped.setdefault(entry['repo_name'], {}).setdefault(entry['sonar_status'], []).append(entry)
+
+    body = f"SonarQube Scan Digest: {len(pending)} result(s)\n"
+    for repo_name in sorted(grouped):
+        body += f"\nRepository Name: {repo_name}\n"
+        for sonar_status in sorted(grouped[repo_name]):
+            body += f"  SonarQube Quality Gate Status: {sonar_status}\n"
+            for entry in grouped[repo_name][sonar_status]:
+                body += f"    - {describe_digest_target(entry)}: {entry['sonarqube_link']}"
+                if entry.get('coverage'):
+                    body += f" (Coverage: {entry['coverage']})"
+                body += "\n"
+    if notified:
+        summary = ", ".join(f"{entry['repo_name']} {describe_digest_target(entry)} ({entry['sonar_status']})" for entry in notified)
+        body += f"\nAlready sent individually: {summary}\n"
+    return body
+
+def flush_digest(bucket_name, topic_name, buffer, etag):
+    """Take the buffer and publish it as one message.
+
+    The buffer is taken by deleting it only if it still has the ETag it was read with, so results
+    buffered in the meantime are never dropped and a window is published by one invocation only.
+    Returns False if the buffer changed and was left in place.
+    """
+    if not delete_if_unchanged(s3_obj, bucket_name, digest_key(topic_name), etag):
+        logger.info(f"Digest buffer for {topic_name} changed before flush, leaving it in place")
+        return False
+
+    pending_count = sum(1 for entry in buffer['entries'].values() if not entry.get('notified'))
+    if not pending_count:
+        logger.info(f"Digest for {topic_name} only held results that were already sent, nothing to publish")
+        return True
+
+    try:
+        sns_send.publish(
+            TopicArn=buffer['topic_arn'],
+            Message=format_digest_message(buffer['entries']),
+            Subject=f"SonarQube Scan Digest ({pending_count} results)"
+        )
+        logger.info(f"Digest with {pending_count} results sent to topic {buffer['topic_arn']}")
+    except (ClientError, BotoCoreError) as e:
+        # Put the entries back so the next flush retries them; results buffered since are newer and win
+        logger.error(f"Failed to send digest to topic {buffer['topic_arn']}: {e}")
+        def requeue(current):
+            if current is None:
+                return buffer
+            current['window_start'] = min(current['window_start'], buffer['window_start'])
+            current['entries'] = {**buffer['entries'], **current['entries']}
+            return current
+        update_json(s3_obj, bucket_name, digest_key(topic_name), requeue)
+    return True
+
+def flush_due_digests(bucket_name):
+    """Flush every buffered digest whose window has elapsed. Called from the scheduled trigger.
+
+    A topic that fails to flush is logged and left for the next run; the other topics are still flushed.
+    """
+    now = datetime.now(timezone.utc)
+    paginator = s3_obj.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=digest_prefix):
+        for obj in page.get('Contents', []):
+            topic_name = obj['Key'][len(digest_prefix):-len('.json')]
+            try:
+                # A changed buffer is read again; it may have been flushed by another invocation meanwhile
+                for attempt in range(3):
+                    buffer, etag = read_json(s3_obj, bucket_name, digest_key(topic_name))
+                    if not buffer or not buffer['entries'] or not digest_window_elapsed(buffer, now):
+                        break
+                    if flush_digest(bucket_name, topic_name, buffer, etag):
+                        break
+            except (ClientError, BotoCoreError) as e:
+                logger.error(f"Failed to flush digest for topic {topic_name}: {e}")
+
+def buffer_result_for_digest(bucket_name, topic_name, topic_arn, digest_config, entry):
+    """Add a result to the topic's digest buffer. The latest result per branch/PR replaces older ones.
+
+    Results that were already sent on their own (entry['notified']) never trigger a flush, so they
+    are not sent twice.
+    """
+    if entry['pr_triggered'] == 'true':
+        entry_key = f"{entry['repo_name']}#pr-{entry['pull_request_id']}"
+    else:
+        entry_key = f"{entry['repo_name']}#branch-{entry['branch_name']}"
+
+    def add_entry(buffer):
+        if buffer is None:
+            buffer = {'window_start': datetime.now(timezone.utc).isoformat(), 'entries': {}}
+        buffer['topic_arn'] = topic_arn
+        buffer['window_minutes'] = digest_config.get('window_minutes', int(os.getenv('DIGEST_WINDOW_MINUTES', '15')))
+        buffer['entries'].pop(entry_key, None)
+        buffer['entries'][entry_key] = entry
+        return buffer
+
+    buffer, etag = update_json(s3_obj, bucket_name, digest_key(topic_name), add_entry)
+    logger.info(f"Buffered result for {entry_key} in digest for topic {topic_arn}")
+
+    if not entry['notified'] and digest_window_elapsed(buffer, datetime.now(timezone.utc)):
+        flush_digest(bucket_name, topic_name, buffer, etag)
+
 def process_sonarqube_result(event):
     try:
         body = json.loads(event['body'])
@@ -69,7 +194,7 @@ def process_sonarqube_result(event):
             if condition.get('metric') == 'new_coverage' and condition.get('status') != 'NO_VALUE':
                 coverage = condition.get('value') + '%'
 
-        logger.info("Parsed body: " + json.dumps(body))
+        log_payload("Parsed body", body)
         logger.info(f"SonarQube quality gate status: {sonar_status}")
         logger.info(f"PR triggered: {pr_triggered}")
         logger.info(f"JAR File URL: {jar_file_url}")
@@ -110,59 +235,71 @@ def manage_sns_notifications(repo_name, project_key, branch_name, sonar_status,
 
     mailing_list_key = "config/mailing_list.json"
 
-    mail_list_raw_json = s3_obj.get_object(Bucket=bucket_name, Key=mailing_list_key)
-    mail_list_json = mail_list_raw_json['Body'].read().decode('utf-8')
-    MAIL_LIST = json.loads(mail_list_json)
+    with phase('load_store'):
+        mail_list_raw_json = s3_obj.get_object(Bucket=bucket_name, Key=mailing_list_key)
+        mail_list_json = mail_list_raw_json['Body'].read().decode('utf-8')
+        MAIL_LIST = json.loads(mail_list_json)
 
-    get_cc_repo_tag = codecommit.list_tags_for_resource(
-        resourceArn=f'arn:aws:codecommit:{region}:482680362026:{repo_name}'
-    )
+    with phase('fetch'):
+        get_cc_repo_tag = codecommit.list_tags_for_resource(
+            resourceArn=f'arn:aws:codecommit:{region}:482680362026:{repo_name}'
+        )
     repo_tags = get_cc_repo_tag['tags']
     logger.info(f"The repo tags are {repo_tags}")
 
     relevant_emails = set()
     topic_arn = None
+    topic_name = None
+    digest_config = None
 
-    for repo_tag_key, repo_tag_value in repo_tags.items():
-        for mail_list_tag in MAIL_LIST['tags']:
-            if repo_tag_key == mail_list_tag['key'] and repo_tag_value == mail_list_tag['value']:
-                current_topic_name = f"cdx-sonarqube-notification-{repo_tag_value}"
-                topic_arn = get_or_create_sns_topic(current_topic_name)
+    # Resolve the topic and its current subscriptions
+    with phase('fetch'):
+        for repo_tag_key, repo_tag_value in repo_tags.items():
+            for mail_list_tag in MAIL_LIST['tags']:
+                if repo_tag_key == mail_list_tag['key'] and repo_tag_value == mail_list_tag['value']:
+                    current_topic_name = f"cdx-sonarqube-notification-{repo_tag_value}"
+                    topic_arn = get_or_create_sns_topic(current_topic_name)
+                    topic_name = current_topic_name
+                    digest_config = mail_list_tag.get('digest')
                 
-                for email in mail_list_tag['emails']:
-                    relevant_emails.add(email)
-                    logger.info(f"{email} is relevant for tag {repo_tag_key}:{repo_tag_value}")
-
-    if not topic_arn:
-        default_topic_name = "cdx-sonarqube-notification-default"
-        topic_arn = get_or_create_sns_topic(default_topic_name)
-        logger.info(f"Using default SNS topic: {default_topic_name}")
-
-    next_token = None
-    subscriptions = []
-    while True:
-        if next_token:
-            response = sns_send.list_subscriptions_by_topic(TopicArn=topic_arn, NextToken=next_token)
-        else:
-            response = sns_send.list_subscriptions_by_topic(TopicArn=topic_arn)
-
-        subscriptions.extend(response['Subscriptions'])
-        next_token = response.get('NextToken')
-        if not next_token:
-            break
-
-    subscribed_emails_set = {sub['Endpoint'] for sub in subscriptions if sub['Protocol'] == 'email'}
-    subscribed_arns = {sub['SubscriptionArn']: sub['Endpoint'] for sub in subscriptions if sub['Protocol'] == 'email'}
-
-    for email in relevant_emails:
-        if email not in subscribed_emails_set:
-            subscribe_email_to_topic(topic_arn, email)
-        else:
-            logger.info(f"{email} is already subscribed to {topic_arn}")
-
-    for sub_arn, email in subscribed_arns.items():
-        if email not in relevant_emails:
-            unsubscribe_email_from_topic(sub_arn)
+                    for email in mail_list_tag['emails']:
+                        relevant_emails.add(email)
+                        logger.info(f"{email} is relevant for tag {repo_tag_key}:{repo_tag_value}")
+
+        if not topic_arn:
+            default_topic_name = "cdx-sonarqube-notification-default"
+            topic_arn = get_or_create_sns_topic(default_topic_name)
+            topic_name = default_topic_name
+            digest_config = MAIL_LIST.get('default_digest')
+            logger.info(f"Using default SNS topic: {default_topic_name}")
+
+        next_token = None
+        subscriptions = []
+        while True:
+            if next_token:
+                response = sns_send.list_subscriptions_by_topic(TopicArn=topic_arn, NextToken=next_token)
+            else:
+                response = sns_send.list_subscriptions_by_topic(TopicArn=topic_arn)
+
+            subscriptions.extend(response['Subscriptions'])
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+
+        subscribed_emails_set = {sub['Endpoint'] for sub in subscriptions if sub['Protocol'] == 'email'}
+        subscribed_arns = {sub['SubscriptionArn']: sub['Endpoint'] for sub in subscriptions if sub['Protocol'] == 'email'}
+
+    # Reconcile the subscriptions with the mailing list
+    with phase('write'):
+        for email in relevant_emails:
+            if email not in subscribed_emails_set:
+                subscribe_email_to_topic(topic_arn, email)
+            else:
+                logger.info(f"{email} is already subscribed to {topic_arn}")
+
+        for sub_arn, email in subscribed_arns.items():
+            if email not in relevant_emails:
+                unsubscribe_email_from_topic(sub_arn)
 
     if pr_triggered == 'true':
         sonarqube_link = f"{sonarqube_host}/dashboard?id={project_key}&pullRequest={pull_request_id}"
@@ -188,19 +325,51 @@ def manage_sns_notifications(repo_name, project_key, branch_name, sonar_status,
         if jar_url:
             body += f"JAR File URL (Expired in 1 hour): {jar_url}"
 
+    if digest_config and digest_config.get('enabled'):
+        # Failing statuses can still be sent immediately; they are also kept in the digest
+        # so it reflects the latest status for the branch/PR
+        bypass = sonar_status in digest_config.get('bypass_statuses', ['ERROR'])
+        with phase('write'):
+            buffer_result_for_digest(bucket_name, topic_name, topic_arn, digest_config, {
+                'repo_name': repo_name,
+                'sonar_status': sonar_status,
+                'branch_name': branch_name,
+                'pr_triggered': pr_triggered,
+                'pr_branch': pr_branch,
+                'pr_base': pr_base,
+                'pull_request_id': pull_request_id,
+                'sonarqube_link': sonarqube_link,
+                'coverage': coverage,
+                'notified': bypass
+            })
+        if not bypass:
+            return
+
     subject = f"SonarQube Scan Result for {repo_name}"
-    try:
-        sns_send.publish(
-            TopicArn=topic_arn,
-            Message=body,
-            Subject=subject
-        )
-        logger.info(f"Notification sent to topic {topic_arn}")
-    except ClientError as e:
-        logger.error(f"Failed to send notification to topic {topic_arn}: {e}")
+    with phase('write'):
+        try:
+            sns_send.publish(
+                TopicArn=topic_arn,
+                Message=body,
+                Subject=subject
+            )
+            logger.info(f"Notification sent to topic {topic_arn}")
+        except ClientError as e:
+            logger.error(f"Failed to send notification to topic {topic_arn}: {e}")
 
+@instrumented_handler('cdx-sonarqube-result-email-notif')
 def lambda_handler(event, context):
-    logger.info("Received event: " + json.dumps(event))
+    log_payload("Received event", event)
+
+    # Scheduled trigger (EventBridge rule) flushes the digests whose window has elapsed
+    if event.get('detail-type') == 'Scheduled Event':
+        with phase('write'):
+            flush_due_digests(os.getenv('S3_BUCKET', 'cdk-data-pipeline-center-test'))
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Digests flushed')
+        }
+
     sonarqube_host = os.getenv('SONARQUBE_HOST', 'http://localhost:9000')
 
     result = process_sonarqube_result(event)
@@ -0,0 +1,224 @@
+"""Shared instrumentation for the cdx lambdas.
+
+Times every AWS call and handler phase, counts calls, retries, throttles and
+errors, and prints them as one CloudWatch Embedded Metric Format (EMF) record
+at the end of each invocation. Payload logging goes through log_payload so it is
+sampled instead of always on.
+
+This file has to be packaged next to each lambda file (or shipped in a layer).
+"""
+import functools
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from botocore.exceptions import BotoCoreError, ClientError
+
+METRIC_NAMESPACE = os.getenv('METRIC_NAMESPACE', 'CDX/Lambda')
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0.01'))
+
+THROTTLE_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+}
+
+_current = None
+
+
+class InvocationMetrics:
+    """Metrics collected during one handler invocation."""
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.operations = {}
+        self.phases = {}
+        self.phase_stack = []
+        self.started = time.perf_counter()
+        self.sample_payloads = random.random() < PAYLOAD_LOG_SAMPLE_RATE
+
+    def operation(self, name):
+        return self.operations.setdefault(name, {'Calls': 0, 'Latency': 0.0, 'Retries': 0, 'Throttles': 0, 'Errors': 0})
+
+    def record_call(self, name, elapsed_ms, retries=0, error_code=None):
+        stats = self.operation(name)
+        stats['Calls'] += 1
+        stats['Latency'] += elapsed_ms
+        stats['Retries'] += retries
+        if error_code:
+            stats['Errors'] += 1
+
+    def record_phase(self, name, elapsed_ms):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed_ms
+
+    def emf_record(self):
+        """One EMF record for the whole invocation, with per-operation and per-phase metric names."""
+        values = {'Duration': (time.perf_counter() - self.started) * 1000}
+        units = {'Duration': 'Milliseconds'}
+        for name, stats in sorted(self.operations.items()):
+            for stat, value in stats.items():
+                values[f'{name}.{stat}'] = value
+            units[f'{name}.Latency'] = 'Milliseconds'
+        for name, elapsed_ms in sorted(self.phases.items()):
+            values[f'Phase.{name}'] = elapsed_ms
+            units[f'Phase.{name}'] = 'Milliseconds'
+        values['AwsCalls'] = sum(stats['Calls'] for stats in self.operations.values())
+        values['AwsRetries'] = sum(stats['Retries'] for stats in self.operations.values())
+        values['AwsThrottles'] = sum(stats['Throttles'] for stats in self.operations.values())
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRIC_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in values],
+                }],
+            },
+            'FunctionName': self.function_name,
+        }
+        record.update({name: round(value, 2) if isinstance(value, float) else value for name, value in values.items()})
+        return record
+
+
+def describe_error(e):
+    """Error code and retry count of a failed call. Errors without a response, such as timeouts or
+    EndpointConnectionError, are reported by their class name."""
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code'), e.response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    return type(e).__name__, 0
+
+
+def current_metrics():
+    """Metrics of the running invocation, or None outside an instrumented handler."""
+    return _current
+
+
+class InstrumentedPaginator:
+    def __init__(self, paginator, operation_name):
+        self._paginator = paginator
+        self._operation_name = operation_name
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        while True:
+            started = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except (ClientError, BotoCoreError) as e:
+                metrics = current_metrics()
+                if metrics:
+                    error_code, retries = describe_error(e)
+                    metrics.record_call(self._operation_name, (time.perf_counter() - started) * 1000, retries, error_code)
+                raise
+            metrics = current_metrics()
+            if metrics:
+                retries = page.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+                metrics.record_call(self._operation_name, (time.perf_counter() - started) * 1000, retries)
+            yield page
+
+
+class InstrumentedClient:
+    """Proxy around a boto3 client that records every API call in the current invocation's metrics."""
+
+    def __init__(self, client, service_name):
+        self._client = client
+        self._service_name = service_name
+        # Real clients report throttled attempts through botocore's retry event,
+        # which also sees the throttles that were retried successfully
+        self._throttles_from_events = hasattr(client, 'meta') and hasattr(client.meta, 'events')
+        if self._throttles_from_events:
+            client.meta.events.register_first(f'needs-retry.{client.meta.service_model.service_id.hyphenize()}', self._on_needs_retry)
+
+    def _on_needs_retry(self, response=None, operation=None, **kwargs):
+        metrics = current_metrics()
+        if metrics and response and operation is not None:
+            error_code = response[1].get('Error', {}).get('Code')
+            if error_code in THROTTLE_ERROR_CODES:
+                metrics.operation(f'{self._service_name}.{operation.name}')['Throttles'] += 1
+
+    def get_paginator(self, operation_name):
+        name = ''.join(part.capitalize() for part in operation_name.split('_'))
+        return InstrumentedPaginator(self._client.get_paginator(operation_name), f'{self._service_name}.{name}')
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr) or name in ('can_paginate', 'get_waiter'):
+            return attr
+        operation_name = f"{self._service_name}.{''.join(part.capitalize() for part in name.split('_'))}"
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = attr(*args, **kwargs)
+            except (ClientError, BotoCoreError) as e:
+                metrics = current_metrics()
+                if metrics:
+                    error_code, retries = describe_error(e)
+                    metrics.record_call(operation_name, (time.perf_counter() - started) * 1000, retries, error_code)
+                    if not self._throttles_from_events and error_code in THROTTLE_ERROR_CODES:
+                        metrics.operation(operation_name)['Throttles'] += 1
+                raise
+            metrics = current_metrics()
+            if metrics:
+                retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) if isinstance(response, dict) else 0
+                metrics.record_call(operation_name, (time.perf_counter() - started) * 1000, retries)
+            return response
+
+        # Cache the wrapper so later calls skip __getattr__
+        setattr(self, name, call)
+        return call
+
+
+def instrument_client(client, service_name):
+    """Wrap a boto3 client so its calls are timed and counted."""
+    return InstrumentedClient(client, service_name)
+
+
+@contextmanager
+def phase(name):
+    """Time a handler phase, e.g. load_store, fetch, aggregate or write.
+
+    Time spent in a nested phase is taken out of the enclosing one, so each phase reports its own time.
+    """
+    metrics = current_metrics()
+    started = time.perf_counter()
+    if metrics:
+        metrics.phase_stack.append(0.0)
+    try:
+        yield
+    finally:
+        if metrics:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics.record_phase(name, elapsed_ms - metrics.phase_stack.pop())
+            if metrics.phase_stack:
+                metrics.phase_stack[-1] += elapsed_ms
+
+
+def log_payload(label, payload):
+    """Print a full payload only for invocations picked by PAYLOAD_LOG_SAMPLE_RATE."""
+    metrics = current_metrics()
+    if metrics and metrics.sample_payloads:
+        print(f"{label}: {json.dumps(payload, default=str)}")
+
+
+def instrumented_handler(function_name):
+    """Decorator for lambda_handler: collects metrics for the invocation and prints them as EMF at the end."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current
+            _current = InvocationMetrics(getattr(context, 'function_name', None) or function_name)
+            try:
+                return handler(event, context)
+            finally:
+                print(json.dumps(_current.emf_record()))
+                _current = None
+        return wrapper
+    return decorator
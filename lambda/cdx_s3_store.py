@@ -0,0 +1,71 @@
+"""Small JSON objects in S3 that several invocations update at the same time.
+
+Every write is conditional on the ETag that was read (or on the object not
+existing yet), and is retried from a fresh read when another invocation got
+there first, so concurrent updates are neither lost nor applied twice.
+
+This file has to be packaged next to each lambda file that uses it (or shipped in a layer).
+"""
+import json
+import random
+import time
+from botocore.exceptions import ClientError
+
+WRITE_ATTEMPTS = 5
+
+# S3 answers a conditional write or delete that lost a race with one of these
+WRITE_CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey'}
+
+
+def is_write_conflict(e):
+    return isinstance(e, ClientError) and e.response['Error']['Code'] in WRITE_CONFLICT_CODES
+
+
+def read_json(s3, bucket_name, key):
+    """Retrieve a JSON object and its ETag, or (None, None) if it does not exist."""
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+        raise e
+
+
+def update_json(s3, bucket_name, key, update):
+    """Apply update(current) to a JSON object and write it back only if nobody changed it in between.
+
+    update receives the current value (None if the object does not exist) and returns the new
+    value, or None to leave the object as it is. It may be called several times, so it must
+    only depend on the value it is given. Returns the resulting value and its ETag.
+    """
+    for attempt in range(WRITE_ATTEMPTS):
+        current, etag = read_json(s3, bucket_name, key)
+        updated = update(current)
+        if updated is None:
+            return current, etag
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = s3.put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=json.dumps(updated),
+                ContentType='application/json',
+                **condition
+            )
+            return updated, response['ETag']
+        except ClientError as e:
+            if not is_write_conflict(e) or attempt == WRITE_ATTEMPTS - 1:
+                raise e
+            time.sleep(random.uniform(0.05, 0.2))
+
+
+def delete_if_unchanged(s3, bucket_name, key, etag):
+    """Delete an object only if it still has the given ETag. Returns False if it changed or is gone."""
+    try:
+        s3.delete_object(Bucket=bucket_name, Key=key, IfMatch=etag)
+        return True
+    except ClientError as e:
+        if is_write_conflict(e):
+            return False
+        raise e